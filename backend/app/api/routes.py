@@ -1,9 +1,56 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+import cv2
+import numba
 from fastapi import APIRouter, HTTPException
 from app.models.schemas import ProcessRequest, ProcessResponse, PreviewRequest, PreviewResponse, AnalyzeRequest, AnalyzeResponse
 from app.processing.pipeline import process_image, preview_image, analyze_colors
 
 router = APIRouter(prefix="/api")
 
+# The pipeline is synchronous CPU work — run it in worker processes so it
+# doesn't block the event loop and concurrent requests run in parallel.
+# Started and stopped by the app lifespan (see main.py).
+executor: Optional[ProcessPoolExecutor] = None
+
+
+def _init_worker() -> None:
+    """Pin each worker's libraries to one thread — the pool supplies the parallelism."""
+    cv2.setNumThreads(1)
+    numba.set_num_threads(1)
+
+
+def start_executor() -> None:
+    global executor
+    executor = ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_worker)
+
+
+def shutdown_executor() -> None:
+    global executor
+    if executor is not None:
+        executor.shutdown(cancel_futures=True)
+        executor = None
+
+
+async def run_in_executor(fn, request):
+    """Run a pipeline call in the worker pool, replacing the pool if a worker died."""
+    if executor is None:
+        start_executor()
+    pool = executor
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, request)
+    except BrokenProcessPool:
+        # A worker was killed (e.g. out of memory) — the pool is unusable from
+        # here on, so swap in a fresh one for later requests
+        if executor is pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+            start_executor()
+        raise
+
 
 @router.post("/process", response_model=ProcessResponse)
 async def process_endpoint(request: ProcessRequest):
@@ -12,7 +59,7 @@ async def process_endpoint(request: ProcessRequest):
     Runs the full pipeline: quantization → cleanup → thickness → smoothing.
     """
     try:
-        result = process_image(request)
+        result = await run_in_executor(process_image, request)
         return result
     except ValueError as e:
         print(f"[PROCESS ERROR] {e}")
@@ -27,8 +74,11 @@ async def process_endpoint(request: ProcessRequest):
 async def preview_endpoint(request: PreviewRequest):
     """Fast low-res preview — quantize only, no cleanup passes."""
     try:
-        result = preview_image(request)
+        result = await run_in_executor(preview_image, request)
         return result
+    except ValueError as e:
+        print(f"[PREVIEW ERROR] {e}")
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -39,8 +89,11 @@ async def preview_endpoint(request: PreviewRequest):
 async def analyze_endpoint(request: AnalyzeRequest):
     """Analyze image to suggest optimal color count."""
     try:
-        result = analyze_colors(request)
+        result = await run_in_executor(analyze_colors, request)
         return result
+    except ValueError as e:
+        print(f"[ANALYZE ERROR] {e}")
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         import traceback
         traceback.print_exc()
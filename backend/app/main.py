@@ -1,11 +1,23 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from app.api.routes import router
+from app.api.routes import router, start_executor, shutdown_executor
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Processing worker pool lives as long as the app
+    start_executor()
+    yield
+    shutdown_executor()
+
 
 app = FastAPI(
     title="Tuft Studio API",
     version="0.1.0",
     description="Image processing backend for Tuft Studio",
+    lifespan=lifespan,
 )
 
 # CORS — allow frontend origins
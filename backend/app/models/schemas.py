@@ -1,13 +1,16 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Literal
 
+# Color labels are stored as uint8 throughout the pipeline
+MAX_PALETTE_SIZE = 255
+
 
 class ProcessRequest(BaseModel):
     image: str  # base64 encoded
     width: float
     height: float
     unit: Literal["in", "cm"] = "in"
-    paletteSize: int = 8
+    paletteSize: int = Field(8, ge=1, le=MAX_PALETTE_SIZE)
     minThickness: float = 5.0  # mm
     regionThreshold: float = 0.005  # 0.5%
     useYarnPalette: bool = False
@@ -45,7 +48,7 @@ class ProcessResponse(BaseModel):
 
 class PreviewRequest(BaseModel):
     image: str  # base64 encoded
-    paletteSize: int = 8
+    paletteSize: int = Field(8, ge=1, le=MAX_PALETTE_SIZE)
     useYarnPalette: bool = False
     minThickness: float = 5.0
     regionThreshold: float = 0.005
@@ -12,17 +12,25 @@ Major improvements:
   5. Spatial-aware quantization option
 """
 
-import base64
 import io
 import uuid
 from typing import Optional
 
 import cv2
 import numpy as np
-from PIL import Image
-from sklearn.cluster import KMeans
+from numba import njit, prange
+from PIL import Image, UnidentifiedImageError
+from skimage.measure import label as measure_label
 from skimage.segmentation import slic
 
+try:
+    # SIMD-accelerated drop-in for the stdlib base64 codec
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+from sklearn.cluster import KMeans, kmeans_plusplus
+
 from app.models.schemas import (
     ProcessRequest,
     ProcessResponse,
@@ -34,7 +42,12 @@ from app.models.schemas import (
     Layer,
     YarnEstimate,
 )
-from app.processing.yarn_colors import YARN_PALETTE_RGB, YARN_PALETTE_NAMES
+from app.processing.yarn_colors import (
+    YARN_PALETTE_RGB,
+    YARN_PALETTE_NAMES,
+    YARN_PALETTE_LAB,
+    YARN_PALETTE_SQ,
+)
 
 
 # ──────────────────────────────────────────────
@@ -43,7 +56,6 @@ from app.processing.yarn_colors import YARN_PALETTE_RGB, YARN_PALETTE_NAMES
 
 def process_image(request: ProcessRequest) -> ProcessResponse:
     """Run the full processing pipeline on an uploaded image."""
-
     # 1. Decode & normalize
     img_rgb = decode_and_normalize(request.image)
 
@@ -54,8 +66,11 @@ def process_image(request: ProcessRequest) -> ProcessResponse:
     if request.removeBackground:
         img_rgb = remove_background(img_rgb, request.backgroundColorHex)
 
+    # 2c. Reduced working copy for quantization and region cleanup (steps 3-5)
+    img_work = limit_resolution(img_rgb, max_dim=1000)
+
     # 3. Pre-quantization smoothing
-    img_smoothed = pre_quantization_smooth(img_rgb)
+    img_smoothed = pre_quantization_smooth(img_work)
 
     # 3b. SLIC superpixel segmentation (edge-aware spatial grouping)
     segments, seg_colors_lab, seg_sizes = compute_superpixels(img_smoothed)
@@ -83,6 +98,12 @@ def process_image(request: ProcessRequest) -> ProcessResponse:
     for _ in range(4):
         labels = cleanup_small_regions(labels, threshold_ratio=request.regionThreshold)
 
+    # 5b. Back to full resolution. Thickness enforcement derives its kernel
+    #     from px/mm, so it must see the full-size labels.
+    h, w = img_rgb.shape[:2]
+    if labels.shape != (h, w):
+        labels = cv2.resize(labels, (w, h), interpolation=cv2.INTER_NEAREST)
+
     # 6. Enforce minimum feature thickness
     labels = enforce_min_thickness(
         labels, len(palette_rgb),
@@ -90,7 +111,8 @@ def process_image(request: ProcessRequest) -> ProcessResponse:
     )
 
     # 7. Contour-based edge smoothing (Douglas-Peucker)
-    labels = smooth_edges_contour(labels, len(palette_rgb))
+    contours_by_color = extract_simplified_contours(labels, len(palette_rgb))
+    labels = rasterize_from_contours(contours_by_color, labels.shape)
 
     # 8. Final cleanup
     for _ in range(2):
@@ -101,11 +123,14 @@ def process_image(request: ProcessRequest) -> ProcessResponse:
         palette_rgb = refit_palette(img_rgb, labels, len(palette_rgb))
 
     # Rebuild final image
-    h, w = labels.shape
     quantized = palette_rgb[labels.flatten()].reshape(h, w, 3).astype(np.uint8)
 
-    # 10. Generate outline SVG from color boundaries
-    outline_svg = generate_outline_svg(labels, len(palette_rgb))
+    # 10. Generate outline SVG from the final color boundaries — traced
+    #     after step 8 so it matches the layers, with lighter smoothing
+    outline_contours = extract_simplified_contours(
+        labels, len(palette_rgb), epsilon_ratio=0.001, min_epsilon=0.5
+    )
+    outline_svg = generate_outline_svg_from_contours(outline_contours, labels.shape)
 
     # Build response
     palette, layers, yarn_estimates = build_output(
@@ -192,9 +217,8 @@ def analyze_colors(request: AnalyzeRequest) -> AnalyzeResponse:
     k_range = list(range(3, 13))
     inertias = []
     for k in k_range:
-        km = KMeans(n_clusters=k, random_state=42, n_init=5, max_iter=200)
-        km.fit(pixels_lab)
-        inertias.append(float(km.inertia_))
+        _, _, inertia = kmeans_lab(pixels_lab, k, n_init=5, max_iter=200)
+        inertias.append(inertia)
 
     # Elbow detection: find K where second derivative is largest
     # (i.e. the sharpest bend in the curve)
@@ -222,7 +246,18 @@ def analyze_colors(request: AnalyzeRequest) -> AnalyzeResponse:
 def decode_and_normalize(image_b64: str) -> np.ndarray:
     """Decode base64 image, strip alpha, normalize orientation."""
     image_data = base64.b64decode(image_b64)
-    pil_image = Image.open(io.BytesIO(image_data))
+
+    # OpenCV decodes straight into an array (libjpeg-turbo for JPEG),
+    # applies the EXIF orientation tag itself, and IMREAD_COLOR drops alpha
+    img_bgr = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img_bgr is not None:
+        return cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+
+    # Fall back to PIL for formats OpenCV can't read
+    try:
+        pil_image = Image.open(io.BytesIO(image_data))
+    except UnidentifiedImageError:
+        raise ValueError("Unsupported or corrupt image")
 
     try:
         from PIL import ImageOps
@@ -320,19 +355,19 @@ def pre_quantization_smooth(img_rgb: np.ndarray) -> np.ndarray:
     The result looks slightly "posterized" which is exactly what we want —
     the quantizer will then snap these pre-flattened areas into clean regions.
     """
-    # Pass 1: Median filter (strong — 7px kernel)
+    # Pass 1: Median filter (5px kernel)
     # Median is ideal here because it removes noise without creating
-    # new intermediate colors at edges like Gaussian does
-    smoothed = cv2.medianBlur(img_rgb, 7)
+    # new intermediate colors at edges like Gaussian does. OpenCV has a
+    # vectorized path up to 5px; 7px falls back to the much slower
+    # histogram implementation.
+    smoothed = cv2.medianBlur(img_rgb, 5)
 
     # Pass 2: Edge-preserving bilateral filter
     # d=9, sigmaColor=75 means "aggressively smooth similar colors
-    # but stop at strong edges"
+    # but stop at strong edges". Already edge-preserving, so no trailing
+    # median cleanup pass is needed.
     smoothed = cv2.bilateralFilter(smoothed, d=9, sigmaColor=75, sigmaSpace=75)
 
-    # Pass 3: One more median to clean any bilateral artifacts
-    smoothed = cv2.medianBlur(smoothed, 5)
-
     return smoothed
 
 
@@ -399,25 +434,19 @@ def quantize_colors(
     h, w = img_rgb.shape[:2]
 
     if segments is not None and seg_colors_lab is not None and seg_sizes is not None:
-        # Cluster superpixel average colors (weighted by area)
-        kmeans = KMeans(
-            n_clusters=n_colors,
-            random_state=42,
-            n_init=15,
-            max_iter=500,
+        # Cluster superpixel average colors, weighting samples by
+        # superpixel size for better cluster balance
+        seg_labels, centers, _ = kmeans_lab(
+            seg_colors_lab, n_colors, sample_weight=seg_sizes,
+            n_init=15, max_iter=500,
         )
-        # Weight samples by superpixel size for better cluster balance
-        sample_weights = seg_sizes.astype(np.float64)
-        kmeans.fit(seg_colors_lab, sample_weight=sample_weights)
-
-        # Assign each superpixel to its cluster
-        seg_labels = kmeans.predict(seg_colors_lab)
+        seg_labels = seg_labels.astype(np.uint8)
 
         # Map back to pixel-level labels
         labels = seg_labels[segments]
 
         # Convert centers to RGB
-        centers_lab = kmeans.cluster_centers_.astype(np.uint8)
+        centers_lab = centers.astype(np.uint8)
         centers_rgb = cv2.cvtColor(
             centers_lab.reshape(1, -1, 3), cv2.COLOR_LAB2RGB
         ).reshape(-1, 3)
@@ -426,25 +455,20 @@ def quantize_colors(
         img_lab = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2LAB).astype(np.float32)
         pixels_lab = img_lab.reshape(-1, 3)
 
-        n_pixels = len(pixels_lab)
-        max_samples = 150_000
-        if n_pixels > max_samples:
-            rng = np.random.RandomState(42)
-            sample_idx = rng.choice(n_pixels, max_samples, replace=False)
-            sample = pixels_lab[sample_idx]
+        # Both K-Means paths label every input pixel themselves, so no
+        # subsample + predict round-trip is needed
+        if n_colors <= NUMBA_KMEANS_MAX_K:
+            labels, centers, _ = kmeans_lab(pixels_lab, n_colors, n_init=5, max_iter=20)
         else:
-            sample = pixels_lab
-
-        kmeans = KMeans(
-            n_clusters=n_colors,
-            random_state=42,
-            n_init=15,
-            max_iter=500,
-        )
-        kmeans.fit(sample)
-        labels = kmeans.predict(pixels_lab).reshape(h, w)
+            # Attempts replace n_init and KMEANS_PP_CENTERS gives k-means++ seeding
+            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1.0)
+            cv2.setRNGSeed(42)
+            _, labels, centers = cv2.kmeans(
+                pixels_lab, n_colors, None, criteria, 5, cv2.KMEANS_PP_CENTERS
+            )
+        labels = labels.astype(np.uint8).reshape(h, w)
 
-        centers_lab = kmeans.cluster_centers_.astype(np.uint8)
+        centers_lab = centers.astype(np.uint8)
         centers_rgb = cv2.cvtColor(
             centers_lab.reshape(1, -1, 3), cv2.COLOR_LAB2RGB
         ).reshape(-1, 3)
@@ -454,6 +478,135 @@ def quantize_colors(
     return quantized, centers_rgb, labels
 
 
+# Up to this many clusters the compiled 3-channel Lloyd kernel below is
+# used; past it the per-point loop over centers stops paying off
+NUMBA_KMEANS_MAX_K = 16
+
+# Max samples drawn for k-means++ seeding
+KMEANS_SEED_SAMPLES = 20_000
+
+
+def kmeans_lab(
+    samples: np.ndarray, n_colors: int,
+    sample_weight: Optional[np.ndarray] = None,
+    n_init: int = 5, max_iter: int = 300, tol: float = 1e-4,
+) -> tuple[np.ndarray, np.ndarray, float]:
+    """
+    (Weighted) K-Means on (N, 3) LAB samples with k-means++ seeding.
+    Returns (labels, centers, inertia) of the best of n_init runs.
+
+    For n_colors <= NUMBA_KMEANS_MAX_K runs Lloyd iterations in Numba
+    kernels specialized for 3 channels; otherwise uses library KMeans.
+    """
+    if n_colors > NUMBA_KMEANS_MAX_K:
+        kmeans = KMeans(n_clusters=n_colors, random_state=42, n_init=n_init, max_iter=max_iter)
+        kmeans.fit(samples, sample_weight=sample_weight)
+        return kmeans.labels_, kmeans.cluster_centers_, float(kmeans.inertia_)
+
+    samples = np.ascontiguousarray(samples, dtype=np.float32)
+    n_samples = len(samples)
+    if sample_weight is None:
+        weights = np.ones(n_samples, dtype=np.float64)
+    else:
+        weights = np.asarray(sample_weight, dtype=np.float64)
+
+    # Same convergence criterion as sklearn: center shift relative to
+    # the mean per-channel variance
+    tol = tol * float(np.mean(np.var(samples, axis=0)))
+
+    rng = np.random.RandomState(42)
+
+    # k-means++ seeding is O(N·K) per center in NumPy — seed from a
+    # subsample and let the Lloyd iterations use every sample
+    if n_samples > KMEANS_SEED_SAMPLES:
+        seed_idx = rng.choice(n_samples, KMEANS_SEED_SAMPLES, replace=False)
+        seed_samples, seed_weights = samples[seed_idx], weights[seed_idx]
+    else:
+        seed_samples, seed_weights = samples, weights
+
+    labels = np.empty(n_samples, dtype=np.int32)
+    min_dists = np.empty(n_samples, dtype=np.float32)
+    best: tuple[np.ndarray, np.ndarray, float] | None = None
+
+    for _ in range(n_init):
+        centers, _ = kmeans_plusplus(
+            seed_samples, n_colors, sample_weight=seed_weights, random_state=rng
+        )
+        centers = centers.astype(np.float32)
+
+        for _ in range(max_iter):
+            _assign_nearest_3d(samples, centers, labels, min_dists)
+            if _update_centers_3d(samples, weights, labels, centers) <= tol:
+                break
+
+        # Final assignment so labels match the returned centers
+        _assign_nearest_3d(samples, centers, labels, min_dists)
+        inertia = float(np.dot(weights, min_dists))
+
+        if best is None or inertia < best[2]:
+            best = (labels.copy(), centers.copy(), inertia)
+
+    return best
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _assign_nearest_3d(
+    samples: np.ndarray, centers: np.ndarray,
+    labels: np.ndarray, min_dists: np.ndarray,
+) -> None:
+    """Nearest center and its squared distance for every sample."""
+    n_centers = centers.shape[0]
+    for i in prange(samples.shape[0]):
+        x, y, z = samples[i, 0], samples[i, 1], samples[i, 2]
+        # Seed with center 0 — fastmath assumes no infinities, so no np.inf
+        dx = x - centers[0, 0]
+        dy = y - centers[0, 1]
+        dz = z - centers[0, 2]
+        best = 0
+        best_d = dx * dx + dy * dy + dz * dz
+        for c in range(1, n_centers):
+            dx = x - centers[c, 0]
+            dy = y - centers[c, 1]
+            dz = z - centers[c, 2]
+            d = dx * dx + dy * dy + dz * dz
+            if d < best_d:
+                best_d = d
+                best = c
+        labels[i] = best
+        min_dists[i] = best_d
+
+
+@njit(cache=True)
+def _update_centers_3d(
+    samples: np.ndarray, weights: np.ndarray,
+    labels: np.ndarray, centers: np.ndarray,
+) -> float:
+    """
+    Move each center to the weighted mean of its samples, in place.
+    Empty clusters keep their center. Returns the total squared shift.
+    """
+    n_centers = centers.shape[0]
+    sums = np.zeros((n_centers, 3))
+    totals = np.zeros(n_centers)
+    for i in range(samples.shape[0]):
+        c = labels[i]
+        w = weights[i]
+        sums[c, 0] += w * samples[i, 0]
+        sums[c, 1] += w * samples[i, 1]
+        sums[c, 2] += w * samples[i, 2]
+        totals[c] += w
+
+    shift = 0.0
+    for c in range(n_centers):
+        if totals[c] == 0:
+            continue
+        for ch in range(3):
+            new = sums[c, ch] / totals[c]
+            shift += (new - centers[c, ch]) ** 2
+            centers[c, ch] = new
+    return shift
+
+
 # ──────────────────────────────────────────────
 # Step 4 (alt): Yarn Palette Quantization
 # ──────────────────────────────────────────────
@@ -470,25 +623,13 @@ def quantize_to_yarn_palette(
     """
     h, w = img_rgb.shape[:2]
 
-    yarn_rgb_f = YARN_PALETTE_RGB.astype(np.float32)
-    yarn_lab = cv2.cvtColor(
-        yarn_rgb_f.reshape(1, -1, 3).astype(np.uint8), cv2.COLOR_RGB2LAB
-    ).astype(np.float32).reshape(-1, 3)
-    n_yarn = len(yarn_lab)
+    n_yarn = len(YARN_PALETTE_LAB)
 
     if segments is not None and seg_colors_lab is not None and seg_sizes is not None:
-        n_segs = len(seg_colors_lab)
-
         # Map each superpixel to nearest yarn color
-        batch_size = 5000
-        seg_yarn_indices = np.zeros(n_segs, dtype=np.int32)
-        for start in range(0, n_segs, batch_size):
-            end = min(start + batch_size, n_segs)
-            batch = seg_colors_lab[start:end]
-            dists = np.linalg.norm(
-                batch[:, np.newaxis, :] - yarn_lab[np.newaxis, :, :], axis=2
-            )
-            seg_yarn_indices[start:end] = dists.argmin(axis=1)
+        seg_yarn_indices = nearest_color_indices(
+            seg_colors_lab, YARN_PALETTE_LAB, YARN_PALETTE_SQ
+        )
 
         # Count usage per yarn color (weighted by superpixel area)
         yarn_counts = np.zeros(n_yarn, dtype=np.int64)
@@ -498,19 +639,13 @@ def quantize_to_yarn_palette(
         top_n_yarn_idx = np.argsort(yarn_counts)[::-1][:n_colors]
         top_n_yarn_idx = np.sort(top_n_yarn_idx)
 
-        selected_lab = yarn_lab[top_n_yarn_idx]
+        selected_lab = YARN_PALETTE_LAB[top_n_yarn_idx]
+        selected_sq = YARN_PALETTE_SQ[top_n_yarn_idx]
         selected_rgb = YARN_PALETTE_RGB[top_n_yarn_idx]
         selected_names = [YARN_PALETTE_NAMES[i] for i in top_n_yarn_idx]
 
         # Remap each superpixel to nearest selected yarn color
-        seg_labels = np.zeros(n_segs, dtype=np.int32)
-        for start in range(0, n_segs, batch_size):
-            end = min(start + batch_size, n_segs)
-            batch = seg_colors_lab[start:end]
-            dists = np.linalg.norm(
-                batch[:, np.newaxis, :] - selected_lab[np.newaxis, :, :], axis=2
-            )
-            seg_labels[start:end] = dists.argmin(axis=1)
+        seg_labels = nearest_color_indices(seg_colors_lab, selected_lab, selected_sq)
 
         # Map back to pixel labels
         labels_2d = seg_labels[segments]
@@ -519,34 +654,20 @@ def quantize_to_yarn_palette(
         # Fallback: per-pixel matching (original behavior)
         img_lab = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2LAB).astype(np.float32)
         pixels_lab = img_lab.reshape(-1, 3)
-        n_pixels = len(pixels_lab)
-        batch_size = 50_000
-        yarn_indices = np.zeros(n_pixels, dtype=np.int32)
-
-        for start in range(0, n_pixels, batch_size):
-            end = min(start + batch_size, n_pixels)
-            batch = pixels_lab[start:end]
-            dists = np.linalg.norm(
-                batch[:, np.newaxis, :] - yarn_lab[np.newaxis, :, :], axis=2
-            )
-            yarn_indices[start:end] = dists.argmin(axis=1)
+        yarn_indices = nearest_color_indices(
+            pixels_lab, YARN_PALETTE_LAB, YARN_PALETTE_SQ
+        )
 
         yarn_counts = np.bincount(yarn_indices, minlength=n_yarn)
         top_n_yarn_idx = np.argsort(yarn_counts)[::-1][:n_colors]
         top_n_yarn_idx = np.sort(top_n_yarn_idx)
 
-        selected_lab = yarn_lab[top_n_yarn_idx]
+        selected_lab = YARN_PALETTE_LAB[top_n_yarn_idx]
+        selected_sq = YARN_PALETTE_SQ[top_n_yarn_idx]
         selected_rgb = YARN_PALETTE_RGB[top_n_yarn_idx]
         selected_names = [YARN_PALETTE_NAMES[i] for i in top_n_yarn_idx]
 
-        labels = np.zeros(n_pixels, dtype=np.int32)
-        for start in range(0, n_pixels, batch_size):
-            end = min(start + batch_size, n_pixels)
-            batch = pixels_lab[start:end]
-            dists = np.linalg.norm(
-                batch[:, np.newaxis, :] - selected_lab[np.newaxis, :, :], axis=2
-            )
-            labels[start:end] = dists.argmin(axis=1)
+        labels = nearest_color_indices(pixels_lab, selected_lab, selected_sq)
 
         labels_2d = labels.reshape(h, w)
         quantized = selected_rgb[labels].reshape(h, w, 3).astype(np.uint8)
@@ -617,7 +738,7 @@ def merge_similar_colors(
         new_idx[old_i] = new_i
 
     # Remap labels
-    remap = np.zeros(n_colors, dtype=np.int32)
+    remap = np.zeros(n_colors, dtype=np.uint8)
     for old_i in range(n_colors):
         target = merge_to[old_i]
         remap[old_i] = new_idx[target]
@@ -640,37 +761,91 @@ def cleanup_small_regions(
 ) -> np.ndarray:
     """
     Remove small floating regions by merging into adjacent dominant color.
+
+    Labels every same-color region in one pass, resolves the dominant
+    neighbor of every small region in one compiled pass, and relabels all
+    small regions at once through a component → color lookup table.
     """
     h, w = labels.shape
     total_pixels = h * w
     min_area = max(int(total_pixels * threshold_ratio), 8)
-    result = labels.copy()
     n_colors = int(labels.max()) + 1
 
-    for color_id in range(n_colors):
-        mask = (result == color_id).astype(np.uint8)
-        num_components, comp_labels, stats, _ = cv2.connectedComponentsWithStats(
-            mask, connectivity=8
-        )
+    # Connected components of equal label value (8-connectivity). No pixel
+    # equals the background value, so every region gets an id from 1.
+    components, n_components = measure_label(
+        labels, connectivity=2, background=-1, return_num=True
+    )
 
-        for comp_id in range(1, num_components):
-            area = stats[comp_id, cv2.CC_STAT_AREA]
-            if area < min_area:
-                comp_mask = (comp_labels == comp_id).astype(np.uint8)
+    areas = np.bincount(components.ravel(), minlength=n_components + 1)
+    is_small = areas < min_area
+    is_small[0] = False
+    if not is_small.any():
+        return labels.copy()
 
-                # Dilate to sample neighbors
-                kernel = np.ones((5, 5), np.uint8)
-                dilated = cv2.dilate(comp_mask, kernel, iterations=2)
-                border = dilated - comp_mask
+    comp_color = np.zeros(n_components + 1, dtype=labels.dtype)
+    comp_color[components.ravel()] = labels.ravel()
 
-                neighbor_labels = result[border.astype(bool)]
-                neighbor_labels = neighbor_labels[neighbor_labels != color_id]
+    new_color = resolve_small_regions(components, comp_color, is_small, n_colors)
+    return new_color[components]
 
-                if len(neighbor_labels) > 0:
-                    dominant = int(np.bincount(neighbor_labels).argmax())
-                    result[comp_labels == comp_id] = dominant
 
-    return result
+@njit(cache=True)
+def resolve_small_regions(
+    components: np.ndarray,
+    comp_color: np.ndarray,
+    is_small: np.ndarray,
+    n_colors: int,
+) -> np.ndarray:
+    """
+    Component → color lookup table with every small component recolored to
+    its dominant neighbor (lowest color id on ties).
+
+    One pass over the component map counts, for each pixel of a small
+    component, the colors of its 8 neighbors in other components. Surviving
+    (large) neighbors are preferred so two adjacent small regions don't just
+    swap colors; small-only clusters fall back to any neighbor.
+    """
+    h, w = components.shape
+    n_components = comp_color.shape[0]
+
+    small_index = np.full(n_components, -1, dtype=np.int64)
+    n_small = 0
+    for cid in range(n_components):
+        if is_small[cid]:
+            small_index[cid] = n_small
+            n_small += 1
+
+    hist_large = np.zeros((n_small, n_colors), dtype=np.int32)
+    hist_all = np.zeros((n_small, n_colors), dtype=np.int32)
+
+    for y in range(h):
+        for x in range(w):
+            cid = components[y, x]
+            s = small_index[cid]
+            if s < 0:
+                continue
+            for ny in range(max(y - 1, 0), min(y + 2, h)):
+                for nx in range(max(x - 1, 0), min(x + 2, w)):
+                    nid = components[ny, nx]
+                    if nid == cid:
+                        continue
+                    color = comp_color[nid]
+                    hist_all[s, color] += 1
+                    if not is_small[nid]:
+                        hist_large[s, color] += 1
+
+    new_color = comp_color.copy()
+    for cid in range(n_components):
+        s = small_index[cid]
+        if s < 0:
+            continue
+        if hist_large[s].sum() > 0:
+            new_color[cid] = np.argmax(hist_large[s])
+        elif hist_all[s].sum() > 0:
+            new_color[cid] = np.argmax(hist_all[s])
+
+    return new_color
 
 
 # ──────────────────────────────────────────────
@@ -703,78 +878,129 @@ def enforce_min_thickness(
         return labels
 
     result = labels.copy()
-    kernel = cv2.getStructuringElement(
-        cv2.MORPH_ELLIPSE, (min_radius * 2 + 1, min_radius * 2 + 1)
-    )
+    ksize = min_radius * 2 + 1
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (ksize, ksize))
+
+    # Colors absent up front can never appear later (lost pixels only go to
+    # colors already present), so one histogram replaces a scan per color
+    counts = np.bincount(result.ravel(), minlength=n_colors)
+
+    # Scratch 0/255 masks reused for every color — every OpenCV call below
+    # writes into one of these instead of allocating a new image
+    mask = np.empty((h, w), dtype=np.uint8)
+    restored = np.empty_like(mask)
+    inverted = np.empty_like(mask)
+    lost = np.empty_like(mask)
+    border = np.empty_like(mask)
+    neighbor_kernel = np.ones((5, 5), np.uint8)
 
     for color_id in range(n_colors):
-        mask = (result == color_id).astype(np.uint8)
-        if mask.sum() == 0:
+        if counts[color_id] == 0:
             continue
 
-        eroded = cv2.erode(mask, kernel, iterations=1)
-        restored = cv2.dilate(eroded, kernel, iterations=1)
-        lost = mask & ~restored
-
-        if lost.any():
-            # Batch reassignment using dilation to find neighbors
-            lost_dilated = cv2.dilate(lost, np.ones((5, 5), np.uint8), iterations=2)
-            border = lost_dilated & ~lost
-            neighbor_vals = result[border.astype(bool)]
-            neighbor_vals = neighbor_vals[neighbor_vals != color_id]
+        cv2.compare(result, color_id, cv2.CMP_EQ, dst=mask)
 
-            if len(neighbor_vals) > 0:
-                dominant = int(np.bincount(neighbor_vals).argmax())
-                result[lost.astype(bool)] = dominant
+        # A color whose bounding box is narrower than the kernel can't
+        # survive the opening at all, so skip the morphology. Only valid
+        # away from the image edge, where erosion treats outside as set.
+        x, y, bw, bh = cv2.boundingRect(mask)
+        if (bw < ksize and 0 < x and x + bw < w) or (bh < ksize and 0 < y and y + bh < h):
+            np.copyto(lost, mask)
+        else:
+            open_binary_mask(mask, kernel, min_radius, dst=restored)
+
+            # lost = mask & ~restored
+            cv2.bitwise_not(restored, dst=inverted)
+            cv2.bitwise_and(mask, inverted, dst=lost)
+
+        if cv2.countNonZero(lost) > 0:
+            # Batch reassignment using dilation to find neighbors:
+            # border = dilate(lost) & ~lost
+            cv2.dilate(lost, neighbor_kernel, dst=border, iterations=2)
+            cv2.bitwise_not(lost, dst=inverted)
+            cv2.bitwise_and(border, inverted, dst=border)
+
+            # Masked histogram of neighbor colors — no gather of the border
+            # pixels into a temporary array
+            neighbor_hist = cv2.calcHist(
+                [result], [0], border, [n_colors], [0, n_colors]
+            ).ravel()
+            neighbor_hist[color_id] = 0
+
+            if neighbor_hist.any():
+                dominant = int(neighbor_hist.argmax())
+                result[lost != 0] = dominant
 
     return result
 
 
-# ──────────────────────────────────────────────
-# Step 7: Contour-based edge smoothing
-# ──────────────────────────────────────────────
+# Above this radius a disk opening via two distance transforms (cost
+# independent of radius) beats kernel morphology (cost grows with k²)
+LARGE_KERNEL_RADIUS = 30
+
 
-def smooth_edges_contour(labels: np.ndarray, n_colors: int) -> np.ndarray:
+def open_binary_mask(
+    mask: np.ndarray, kernel: np.ndarray, radius: int,
+    dst: Optional[np.ndarray] = None,
+) -> np.ndarray:
     """
-    Smooth region boundaries using contour extraction + Douglas-Peucker
-    polygon simplification + re-rasterization.
+    Morphological opening of a 0/255 mask with a disk of the given radius,
+    written into dst when given.
 
-    This is the key quality step. Instead of pushing pixels around with
-    morphological ops, we:
-      1. Extract the boundary of each color region as contours
-      2. Simplify those contours with Douglas-Peucker (removes jaggies,
-         keeps overall shape)
-      3. Re-draw the simplified polygons filled
+    Small kernels use OpenCV morphology directly. Large ones are done with
+    exact Euclidean distance transforms: erosion keeps pixels farther than
+    radius from the background, dilation grows that core back by radius.
+    """
+    if radius < LARGE_KERNEL_RADIUS:
+        return cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, dst=dst)
 
-    Result: vector-quality smooth curves, perfectly flat color fills.
+    dist = cv2.distanceTransform(mask, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    # Eroded core as zeros (distance-transform seeds), everything else 255
+    not_core = cv2.compare(dist, float(radius), cv2.CMP_LE)
+    dist = cv2.distanceTransform(not_core, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    return cv2.compare(dist, float(radius), cv2.CMP_LE, dst=dst)
 
-    Compositing order: largest regions first (background), smallest last
-    (foreground detail) so small features paint over large ones.
+
+# ──────────────────────────────────────────────
+# Step 7: Contour extraction + edge smoothing
+# ──────────────────────────────────────────────
+
+def extract_simplified_contours(
+    labels: np.ndarray,
+    n_colors: int,
+    epsilon_ratio: float = 0.002,
+    min_epsilon: float = 1.0,
+) -> list[tuple[int, list[np.ndarray], np.ndarray]]:
+    """
+    Extract the boundary of each color region and simplify it with
+    Douglas-Peucker (removes jaggies, keeps overall shape).
+
+    Returns (color_id, simplified_contours, hierarchy) per present color,
+    ordered largest region first. Used for both the fill rasterizer and
+    the outline SVG (which passes a smaller epsilon).
     """
     h, w = labels.shape
 
     # Sort colors by area: largest first (they get drawn first = background)
-    color_areas = []
-    for c in range(n_colors):
-        area = int((labels == c).sum())
-        color_areas.append((c, area))
+    areas = np.bincount(labels.ravel(), minlength=n_colors)
+    color_areas = [(c, int(areas[c])) for c in range(n_colors)]
     color_areas.sort(key=lambda x: x[1], reverse=True)
 
-    # Canvas starts as the dominant background color
-    output = np.full((h, w), color_areas[0][0], dtype=np.int32)
-
     # Epsilon for Douglas-Peucker: controls smoothing aggressiveness
     # Larger = smoother curves but less detail
     # Scale with image size so behavior is consistent
-    base_epsilon = max(h, w) * 0.002  # 0.2% of image size
+    base_epsilon = max(h, w) * epsilon_ratio  # default 0.2% of image size
+
+    contours_by_color: list[tuple[int, list[np.ndarray], np.ndarray]] = []
 
     for color_id, area in color_areas:
         if area == 0:
             continue
 
-        mask = (labels == color_id).astype(np.uint8)
+        # 0/255 mask in one pass, no bool → uint8 copy
+        mask = cv2.compare(labels, color_id, cv2.CMP_EQ)
 
-        # Find contours
+        # RETR_CCOMP gives a 2-level hierarchy: outer boundaries and holes
         contours, hierarchy = cv2.findContours(
             mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE
         )
@@ -782,29 +1008,52 @@ def smooth_edges_contour(labels: np.ndarray, n_colors: int) -> np.ndarray:
         if not contours:
             continue
 
-        # Simplify each contour with Douglas-Peucker
         simplified = []
         for cnt in contours:
             perimeter = cv2.arcLength(cnt, True)
             # Adaptive epsilon: smaller regions get less aggressive smoothing
             epsilon = base_epsilon * min(1.0, perimeter / (max(h, w) * 0.5))
-            epsilon = max(epsilon, 1.0)  # minimum smoothing
+            epsilon = max(epsilon, min_epsilon)  # minimum smoothing
             approx = cv2.approxPolyDP(cnt, epsilon, True)
             simplified.append(approx)
 
-        # Re-draw simplified polygons
-        # Use hierarchy to handle holes correctly (RETR_CCOMP gives 2-level hierarchy)
-        canvas = np.zeros((h, w), dtype=np.uint8)
-
-        if hierarchy is not None:
-            # Draw outer contours filled, then subtract holes
-            for i, cnt in enumerate(simplified):
-                if hierarchy[0][i][3] == -1:  # No parent = outer contour
-                    cv2.drawContours(canvas, [cnt], 0, 255, cv2.FILLED)
-                else:  # Has parent = hole
-                    cv2.drawContours(canvas, [cnt], 0, 0, cv2.FILLED)
-        else:
-            cv2.drawContours(canvas, simplified, -1, 255, cv2.FILLED)
+        contours_by_color.append((color_id, simplified, hierarchy[0]))
+
+    return contours_by_color
+
+
+def rasterize_from_contours(
+    contours_by_color: list[tuple[int, list[np.ndarray], np.ndarray]],
+    shape: tuple[int, int],
+) -> np.ndarray:
+    """
+    Re-draw the simplified polygons filled to produce smoothed labels.
+
+    This is the key quality step. Instead of pushing pixels around with
+    morphological ops, region boundaries are replaced by their
+    Douglas-Peucker polygons. Result: vector-quality smooth curves,
+    perfectly flat color fills.
+
+    Compositing order: largest regions first (background), smallest last
+    (foreground detail) so small features paint over large ones.
+    """
+    h, w = shape
+
+    # Canvas starts as the dominant background color
+    output = np.full((h, w), contours_by_color[0][0], dtype=np.uint8)
+
+    # One scratch canvas reused for every color
+    canvas = np.zeros((h, w), dtype=np.uint8)
+
+    for color_id, simplified, hierarchy in contours_by_color:
+        # Draw all outer contours filled, then subtract all holes
+        canvas.fill(0)
+        has_parent = hierarchy[:, 3] != -1
+        outers = [cnt for cnt, hole in zip(simplified, has_parent) if not hole]
+        holes = [cnt for cnt, hole in zip(simplified, has_parent) if hole]
+        cv2.drawContours(canvas, outers, -1, 255, cv2.FILLED)
+        if holes:
+            cv2.drawContours(canvas, holes, -1, 0, cv2.FILLED)
 
         # Paint this color over the output where the simplified mask says so
         output[canvas > 0] = color_id
@@ -830,77 +1079,48 @@ def refit_palette(
     are now stale. By averaging the original RGB values of pixels in each
     final region, we get truer, more saturated colors.
     """
-    h, w = labels.shape
-    original_flat = original_rgb.reshape(-1, 3).astype(np.float64)
-    labels_flat = labels.flatten()
+    original_flat = original_rgb.reshape(-1, 3)
+    labels_flat = labels.ravel()
 
-    new_palette = np.zeros((n_colors, 3), dtype=np.uint8)
+    # Segmented sums: one pass for counts, one per channel for sums.
+    # Empty colors get count 1 and sum 0, i.e. black, as before.
+    counts = np.bincount(labels_flat, minlength=n_colors)[:n_colors]
+    sums = np.stack([
+        np.bincount(labels_flat, weights=original_flat[:, ch], minlength=n_colors)[:n_colors]
+        for ch in range(3)
+    ], axis=1)
 
-    for c in range(n_colors):
-        mask = (labels_flat == c)
-        if mask.sum() > 0:
-            mean_color = original_flat[mask].mean(axis=0)
-            new_palette[c] = np.clip(mean_color, 0, 255).astype(np.uint8)
-
-    return new_palette
+    mean_colors = sums / np.maximum(counts, 1)[:, np.newaxis]
+    return np.clip(mean_colors, 0, 255).astype(np.uint8)
 
 
 # ──────────────────────────────────────────────
 # Step 10: Outline SVG Generation
 # ──────────────────────────────────────────────
 
-def generate_outline_svg(labels: np.ndarray, n_colors: int) -> str:
+def generate_outline_svg_from_contours(
+    contours_by_color: list[tuple[int, list[np.ndarray], np.ndarray]],
+    shape: tuple[int, int],
+) -> str:
     """
-    Generate SVG outline paths from color region boundaries.
-
-    For each color region:
-      1. Extract contours (with hierarchy for holes)
-      2. Simplify with Douglas-Peucker
-      3. Convert to SVG path data
+    Generate SVG outline paths from the simplified region contours
+    produced by extract_simplified_contours.
 
     Returns a complete SVG string with all outline paths.
     The SVG viewBox matches the label dimensions so it can be
     overlaid 1:1 on the processed image.
     """
-    h, w = labels.shape
+    h, w = shape
     paths: list[str] = []
 
-    # Smoothing epsilon — controls curve smoothness
-    base_epsilon = max(h, w) * 0.001  # Slightly less aggressive than fill smoothing
-
-    for color_id in range(n_colors):
-        mask = (labels == color_id).astype(np.uint8)
-        if mask.sum() == 0:
-            continue
-
-        contours, hierarchy = cv2.findContours(
-            mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE
-        )
-
-        if not contours or hierarchy is None:
-            continue
-
-        for i, cnt in enumerate(contours):
-            if len(cnt) < 3:
-                continue
-
-            # Simplify
-            perimeter = cv2.arcLength(cnt, True)
-            epsilon = base_epsilon * min(1.0, perimeter / (max(h, w) * 0.5))
-            epsilon = max(epsilon, 0.5)
-            approx = cv2.approxPolyDP(cnt, epsilon, True)
-
+    for _, simplified, _ in contours_by_color:
+        for approx in simplified:
             if len(approx) < 3:
                 continue
 
-            # Convert to SVG path data
-            points = approx.reshape(-1, 2)
-            d = f"M{points[0][0]},{points[0][1]}"
-            for pt in points[1:]:
-                d += f" L{pt[0]},{pt[1]}"
-            d += " Z"
-
-            paths.append(d)
+            # Convert to SVG path data (single join — repeated += is quadratic)
+            points = approx.reshape(-1, 2).tolist()
+            paths.append("M" + " L".join(f"{x},{y}" for x, y in points) + " Z")
 
     if not paths:
         return ""
@@ -950,13 +1170,22 @@ def build_output(
     layers: list[Layer] = []
     yarn_estimates: list[YarnEstimate] = []
 
+    n_colors = len(palette_rgb)
+    pixel_counts = np.bincount(labels.ravel(), minlength=n_colors)
+
+    # Layer masks are encoded as single-channel PNGs. Requests already run
+    # in parallel worker processes, so each one encodes its layers serially.
+    layer_bitmaps = [
+        encode_mask(cv2.compare(labels, i, cv2.CMP_EQ)) for i in range(n_colors)
+    ]
+
     for i, rgb in enumerate(palette_rgb):
         color_id = str(uuid.uuid4())[:8]
         r, g, b = int(rgb[0]), int(rgb[1]), int(rgb[2])
         hex_val = f"#{r:02x}{g:02x}{b:02x}"
         name = color_names[i] if color_names and i < len(color_names) else ""
 
-        pixel_count = int((labels == i).sum())
+        pixel_count = int(pixel_counts[i])
 
         palette.append(TuftColor(
             id=color_id,
@@ -966,9 +1195,7 @@ def build_output(
             name=name,
         ))
 
-        mask_2d = (labels == i).astype(np.uint8) * 255
-        layer_b64 = encode_image(cv2.cvtColor(mask_2d, cv2.COLOR_GRAY2RGB))
-        layers.append(Layer(colorId=color_id, bitmap=layer_b64))
+        layers.append(Layer(colorId=color_id, bitmap=layer_bitmaps[i]))
 
         coverage = pixel_count / total_pixels if total_pixels > 0 else 0
         area_sq_in = coverage * rug_area
@@ -993,3 +1220,38 @@ def encode_image(img_rgb: np.ndarray) -> str:
     img_bgr = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR)
     _, buffer = cv2.imencode(".png", img_bgr)
     return base64.b64encode(buffer).decode("utf-8")
+
+
+def encode_mask(mask: np.ndarray) -> str:
+    """Encode a single-channel 0/255 mask to base64 grayscale PNG string."""
+    _, buffer = cv2.imencode(".png", mask)
+    return base64.b64encode(buffer).decode("utf-8")
+
+
+def nearest_color_indices(
+    points_lab: np.ndarray, palette_lab: np.ndarray,
+    palette_sq: Optional[np.ndarray] = None, batch_size: int = 50_000,
+) -> np.ndarray:
+    """
+    Index of the nearest palette color for each LAB point, as uint8 (labels
+    are uint8 throughout the pipeline, so palettes hold at most 256 colors).
+
+    Uses the expansion |x - y|² = |x|² - 2·x·y + |y|² so each batch is a
+    single matrix multiply into an (N, K) matrix, instead of materializing
+    an (N, K, 3) difference array. |x|² is constant per row and the sqrt is
+    monotonic, so neither affects the argmin and both are skipped. |y|² can
+    be passed in as palette_sq when precomputed (see YARN_PALETTE_SQ).
+    """
+    points_lab = points_lab.astype(np.float32, copy=False)
+    palette_lab = palette_lab.astype(np.float32, copy=False)
+    if palette_sq is None:
+        palette_sq = (palette_lab ** 2).sum(axis=1)
+
+    n_points = len(points_lab)
+    indices = np.zeros(n_points, dtype=np.uint8)
+    for start in range(0, n_points, batch_size):
+        end = min(start + batch_size, n_points)
+        dists = palette_sq - 2.0 * np.dot(points_lab[start:end], palette_lab.T)
+        indices[start:end] = dists.argmin(axis=1)
+
+    return indices
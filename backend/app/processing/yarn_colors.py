@@ -7,6 +7,9 @@ suppliers (Tuftingpal, The Tufting Studio, Lenzing, etc.)
 Organized by color family. Each entry is (name, R, G, B).
 """
 
+import cv2
+import numpy as np
+
 YARN_PALETTE = [
     # ── Whites & Creams ──
     ("Snow White",        255, 255, 255),
@@ -90,11 +93,16 @@ YARN_PALETTE = [
 ]
 
 # Pre-computed numpy array for fast distance calculations
-import numpy as np
-
 YARN_PALETTE_RGB = np.array(
     [[r, g, b] for (_, r, g, b) in YARN_PALETTE],
     dtype=np.uint8,
 )
 
+# LAB coordinates and their squared norms, for nearest-yarn matching
+YARN_PALETTE_LAB = cv2.cvtColor(
+    YARN_PALETTE_RGB.reshape(1, -1, 3), cv2.COLOR_RGB2LAB
+).reshape(-1, 3).astype(np.float32)
+
+YARN_PALETTE_SQ = (YARN_PALETTE_LAB ** 2).sum(axis=1)
+
 YARN_PALETTE_NAMES = [name for (name, _, _, _) in YARN_PALETTE]
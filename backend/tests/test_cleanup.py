@@ -0,0 +1,48 @@
+import numpy as np
+
+from app.processing.pipeline import cleanup_small_regions
+
+
+def test_small_region_absorbed_into_surrounding_color():
+    labels = np.zeros((100, 100), dtype=np.uint8)
+    labels[48:51, 48:51] = 1
+
+    cleaned = cleanup_small_regions(labels, threshold_ratio=0.005)
+
+    assert cleaned.dtype == np.uint8
+    assert (cleaned == 0).all()
+
+
+def test_large_regions_untouched():
+    labels = np.zeros((100, 100), dtype=np.uint8)
+    labels[:, 50:] = 1
+
+    cleaned = cleanup_small_regions(labels, threshold_ratio=0.005)
+
+    np.testing.assert_array_equal(cleaned, labels)
+
+
+def test_small_region_takes_dominant_neighbor():
+    labels = np.zeros((100, 100), dtype=np.uint8)
+    labels[:, 50:] = 1
+    # Mostly inside color 1, touching color 0 along one edge
+    labels[40:46, 50:53] = 2
+
+    cleaned = cleanup_small_regions(labels, threshold_ratio=0.005)
+
+    assert (cleaned[40:46, 50:53] == 1).all()
+    assert (cleaned[:, :50] == 0).all()
+
+
+def test_adjacent_small_regions_merge_into_large_neighbor():
+    labels = np.zeros((100, 100), dtype=np.uint8)
+    labels[:, 50:] = 1
+    # Two touching small regions inside color 0 — they must not just
+    # swap colors with each other
+    labels[20:24, 20:24] = 2
+    labels[20:24, 24:27] = 3
+
+    cleaned = cleanup_small_regions(labels, threshold_ratio=0.005)
+
+    assert (cleaned[:, :50] == 0).all()
+    assert (cleaned[:, 50:] == 1).all()
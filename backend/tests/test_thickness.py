@@ -0,0 +1,61 @@
+import cv2
+import numpy as np
+
+from app.processing.pipeline import (
+    LARGE_KERNEL_RADIUS,
+    enforce_min_thickness,
+    open_binary_mask,
+)
+
+
+def thin_feature_labels() -> np.ndarray:
+    labels = np.zeros((100, 200), dtype=np.uint8)
+    # 4 px wide stripe along the left edge and a 4 px wide bar inside
+    labels[:, :4] = 1
+    labels[40:60, 100:104] = 2
+    return labels
+
+
+def enforce(labels: np.ndarray) -> np.ndarray:
+    # 200 px over a 15.4 cm rug at 5 mm → radius 3, 7 px kernel
+    return enforce_min_thickness(labels, 3, 5.0, 15.4, 7.7, "cm")
+
+
+def test_thin_color_touching_image_edge_is_kept():
+    labels = thin_feature_labels()
+
+    result = enforce(labels)
+
+    np.testing.assert_array_equal(result == 1, labels == 1)
+
+
+def test_thin_interior_color_is_reassigned():
+    labels = thin_feature_labels()
+
+    result = enforce(labels)
+
+    assert not (result == 2).any()
+    assert (result[40:60, 100:104] == 0).all()
+
+
+def test_large_radius_opening_matches_kernel_morphology():
+    mask = np.zeros((400, 500), dtype=np.uint8)
+    cv2.circle(mask, (120, 120), 80, 255, -1)
+    cv2.rectangle(mask, (250, 50), (450, 90), 255, -1)
+    cv2.rectangle(mask, (250, 200), (280, 380), 255, -1)
+    cv2.ellipse(mask, (380, 300), (90, 50), 30, 0, 360, 255, -1)
+    cv2.line(mask, (20, 350), (200, 250), 255, 25)
+
+    radius = LARGE_KERNEL_RADIUS
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+
+    opened = open_binary_mask(mask, kernel, radius)
+    expected = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+
+    # Opening never adds pixels
+    assert not (opened[mask == 0]).any()
+    # Exact Euclidean disk vs. rasterized kernel only differ along boundaries
+    assert np.count_nonzero(opened != expected) < 0.005 * np.count_nonzero(mask)
+    # Features narrower than the disk are removed by both
+    assert not opened[200:381, 250:281].any()
+    assert not expected[200:381, 250:281].any()